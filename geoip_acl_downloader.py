@@ -7,14 +7,30 @@ removes redundant subnets, and saves them to separate IPv4 and IPv6 files.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import ipaddress
+import io
 import logging
+import re
+import socket
 import sys
 import argparse
-from typing import Set, List, Optional
+from typing import Set, List, Tuple, Iterable, Optional
 from pathlib import Path
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+
+
+# Networks are passed around as (version, network address as int, prefix length)
+# tuples and only turned into ipaddress objects when written out
+NetworkTuple = Tuple[int, int, int]
+
+_ADDRESS_WIDTHS = {4: 32, 6: 128}
+_NETWORK_CLASSES = {4: ipaddress.IPv4Network, 6: ipaddress.IPv6Network}
 
 
 class GeoIPACLDownloader:
@@ -26,6 +42,15 @@ class GeoIPACLDownloader:
         "https://geoip.site/download/DB-IP/GeoIP.acl"
     ]
     
+    # Size of the chunks read from the network while streaming a response
+    CHUNK_SIZE = 64 * 1024
+    
+    # Buffer size for output files, large enough to hold a typical country in one write
+    WRITE_BUFFER_SIZE = 1024 * 1024
+    
+    # Upper bound on concurrent downloads; the work is network-bound, not CPU-bound
+    MAX_WORKERS = 32
+    
     def __init__(self, country_code: str, urls: Optional[List[str]] = None, timeout: int = 30):
         """
         Initialize the downloader.
@@ -38,33 +63,99 @@ class GeoIPACLDownloader:
         self.country_code = country_code.upper()
         self.urls = urls or self.DEFAULT_URLS
         self.timeout = timeout
+        self.max_workers = min(len(self.urls), self.MAX_WORKERS)
         self.logger = logging.getLogger(__name__)
         self.session = requests.Session()
+        
+        # Pool sized for one connection per download worker, retrying transient failures
+        adapter = HTTPAdapter(
+            pool_connections=self.max_workers,
+            pool_maxsize=self.max_workers,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.session.headers.update({
             'User-Agent': f'GeoIP-ACL-Downloader/1.0 (Python) Country/{self.country_code}'
         })
         
-    def download_url(self, url: str) -> Optional[str]:
+        # Country block header, e.g. "acl BR {". Lines before the block are prefiltered by a
+        # plain substring test on the country code; the pattern decides (so "acl BRX" is rejected)
+        # It is searched, not anchored, and may follow a UTF-8 BOM either decoded ('\ufeff')
+        # or mis-decoded as Latin-1 ('ï»¿') when the server declares that charset
+        self._block_start_re = re.compile(
+            rf'(?:^|\s|\ufeff|\u00ef\u00bb\u00bf)acl\s+{re.escape(self.country_code)}(?:\s|{{|$)'
+        )
+        self._cidr_re = re.compile(r'\s*([0-9a-fA-F:.]+(?:/\d{1,3})?)\s*;?\s*$', re.ASCII)
+        
+    def download_url(self, url: str) -> Optional[requests.Response]:
         """
-        Download content from a single URL.
+        Start a streaming download from a single URL.
+        
+        The body is not read here; the caller consumes it (e.g. with
+        response.iter_lines) and is responsible for closing the response.
         
         Args:
             url: URL to download from.
             
         Returns:
-            Downloaded content or None if failed.
+            Streaming response or None if failed.
         """
         try:
             self.logger.info(f"Downloading from: {url}")
-            response = self.session.get(url, timeout=self.timeout)
+            response = self.session.get(url, timeout=self.timeout, stream=True)
+            if not response.ok:
+                response.close()
             response.raise_for_status()
-            self.logger.info(f"Successfully downloaded {len(response.text)} characters from {url}")
-            return response.text
+            # Without a declared charset, decode as UTF-8 (dropping any BOM) rather than
+            # requests' ISO-8859-1 default for text/*, which would mangle a BOM into 'ï»¿'
+            if 'charset' not in response.headers.get('Content-Type', '').lower():
+                response.encoding = 'utf-8-sig'
+            self.logger.info(f"Connected to {url}, streaming response")
+            self.logger.debug(f"Content-Encoding for {url}: {response.headers.get('Content-Encoding', 'identity')}")
+            return response
         except requests.RequestException as e:
             self.logger.error(f"Failed to download from {url}: {e}")
             return None
     
-    def parse_acl_content(self, content: str) -> Set[ipaddress.IPv4Network | ipaddress.IPv6Network]:
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def _fast_parse(token: str) -> NetworkTuple:
+        """
+        Parse a CIDR token such as '1.2.3.0/24' or '2001:db8::/32' into a network tuple.
+        
+        Cheaper than ipaddress.ip_network for the well-formed entries found in ACL files.
+        Host bits are cleared (like strict=False) and a bare address gets a full-length prefix.
+        Anything the fast path can't handle (netmask or hostmask prefixes, scoped IPv6
+        addresses) falls back to ipaddress.ip_network, so the same tokens are accepted.
+        Results are memoized, since the same entries show up in every source.
+        
+        Raises:
+            ValueError: If ipaddress.ip_network rejects the token too.
+        """
+        addr_str, _, prefix_str = token.partition('/')
+        if ':' in addr_str:
+            version, family = 6, socket.AF_INET6
+        else:
+            version, family = 4, socket.AF_INET
+        width = _ADDRESS_WIDTHS[version]
+        
+        try:
+            # Same rule as ipaddress: ASCII digits only (int() would also take '٢٤', '+24', ...)
+            if prefix_str and not (prefix_str.isascii() and prefix_str.isdigit()):
+                raise ValueError(f"Invalid prefix length '{prefix_str}'")
+            prefixlen = int(prefix_str) if prefix_str else width
+            if not 0 <= prefixlen <= width:
+                raise ValueError(f"Invalid prefix length {prefixlen} for IPv{version}")
+            addr = int.from_bytes(socket.inet_pton(family, addr_str), 'big')
+        except (ValueError, OSError):
+            net = ipaddress.ip_network(token, strict=False)
+            return net.version, int(net.network_address), net.prefixlen
+        
+        host_bits = width - prefixlen
+        return version, addr >> host_bits << host_bits, prefixlen
+    
+    def parse_acl_content(self, content: str) -> Set[NetworkTuple]:
         """
         Parse ACL content to extract IP networks for the specified country.
         
@@ -72,69 +163,120 @@ class GeoIPACLDownloader:
             content: Raw ACL file content.
             
         Returns:
-            Set of IP networks found in the content for the specified country.
+            Set of (version, address, prefixlen) tuples found for the specified country.
+        """
+        # StringIO yields one line at a time instead of materializing a list of lines
+        return self.parse_acl_lines(io.StringIO(content))
+    
+    def parse_acl_lines(self, lines: Iterable[str]) -> Set[NetworkTuple]:
+        """
+        Parse ACL lines to extract IP networks for the specified country.
+        
+        Lines are consumed one at a time, so a streaming iterator such as
+        response.iter_lines() never has to be buffered in full. Reading stops
+        as soon as the country block is closed.
+        
+        Args:
+            lines: Iterable of ACL file lines.
+            
+        Returns:
+            Set of (version, address, prefixlen) tuples found for the specified country.
         """
         networks = set()
-        lines = content.split('\n')
-        in_country_block = False
-        acl_pattern = f"acl {self.country_code}"
+        found = False
+        
+        # Bind hot-loop lookups to locals
+        country_code = self.country_code
+        block_start_search = self._block_start_re.search
+        cidr_match = self._cidr_re.match
+        fast_parse = self._fast_parse
         
         for line_num, line in enumerate(lines, 1):
-            line = line.strip()
-            
             # Check for start of country block
-            if acl_pattern in line:
-                in_country_block = True
-                self.logger.debug(f"Found {self.country_code} block at line {line_num}")
+            if not found:
+                if country_code in line and block_start_search(line):
+                    found = True
+                    self.logger.debug(f"Found {self.country_code} block at line {line_num}")
                 continue
             
-            # Check for end of block
-            if "}" in line and in_country_block:
-                in_country_block = False
+            # Each country is listed once, so stop reading at the end of its block
+            if "}" in line:
                 self.logger.debug(f"End of {self.country_code} block at line {line_num}")
-                continue
+                break
             
             # Process IP networks within country block
-            if in_country_block and line:
-                ip_str = line.strip(';').strip()
-                if ip_str and not ip_str.startswith('#'):  # Skip comments
-                    try:
-                        ip_obj = ipaddress.ip_network(ip_str, strict=False)
-                        networks.add(ip_obj)
-                    except ValueError as e:
-                        self.logger.warning(f"Invalid IP network '{ip_str}' at line {line_num}: {e}")
+            match = cidr_match(line)
+            if match:
+                ip_str = match.group(1)
+            else:
+                # Lines the pattern doesn't recognise are still parsed or reported, never dropped
+                ip_str = line.strip().strip(';').strip()
+                if not ip_str or ip_str.startswith('#'):  # Skip blank lines and comments
+                    continue
+            
+            try:
+                networks.add(fast_parse(ip_str))
+            except ValueError as e:
+                self.logger.warning(f"Invalid IP network '{ip_str}' at line {line_num}: {e}")
+        
+        if not found:
+            self.logger.warning(f"Country {self.country_code} not found in source")
         
         return networks
     
-    def download_and_parse_all(self) -> tuple[Set[ipaddress.IPv4Network], Set[ipaddress.IPv6Network]]:
+    def fetch_and_parse(self, url: str) -> Optional[Set[NetworkTuple]]:
+        """
+        Download a single URL and parse it while the body is still streaming in.
+        
+        Args:
+            url: URL to download from.
+            
+        Returns:
+            Set of network tuples for the specified country, or None if the download failed.
+        """
+        response = self.download_url(url)
+        if response is None:
+            return None
+        
+        with response:
+            lines = response.iter_lines(chunk_size=self.CHUNK_SIZE, decode_unicode=True)
+            return self.parse_acl_lines(lines)
+    
+    def download_and_parse_all(self) -> tuple[Set[NetworkTuple], Set[NetworkTuple]]:
         """
         Download and parse all URLs concurrently.
         
         Returns:
             Tuple of (IPv4 networks, IPv6 networks).
         """
-        all_networks = set()
+        # Sources are merged on (version, address, prefixlen) tuples, so duplicates
+        # across sources are dropped by hashing plain ints
+        all_networks: Set[NetworkTuple] = set()
         
-        # Download all URLs concurrently
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_url = {executor.submit(self.download_url, url): url for url in self.urls}
+        # Download and parse all URLs concurrently, each source in its own worker
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='geoip-dl') as executor:
+            future_to_url = {executor.submit(self.fetch_and_parse, url): url for url in self.urls}
             
-            for future in as_completed(future_to_url):
-                url = future_to_url[future]
-                try:
-                    content = future.result()
-                    if content:
-                        networks = self.parse_acl_content(content)
-                        all_networks.update(networks)
-                        self.logger.info(f"Extracted {len(networks)} networks from {url}")
-                    else:
-                        self.logger.warning(f"No content received from {url}")
-                except Exception as e:
-                    self.logger.error(f"Error processing {url}: {e}")
-        
-        # Separate IPv4 and IPv6 networks
-        ipv4_networks = {net for net in all_networks if net.version == 4}
-        ipv6_networks = {net for net in all_networks if net.version == 6}
+            try:
+                for future in as_completed(future_to_url):
+                    url = future_to_url[future]
+                    try:
+                        networks = future.result()
+                        if networks is not None:
+                            all_networks.update(networks)
+                            self.logger.info(f"Extracted {len(networks)} networks from {url}")
+                        else:
+                            self.logger.warning(f"No content received from {url}")
+                    except Exception as e:
+                        self.logger.error(f"Error processing {url}: {e}")
+            except BaseException:
+                # Don't start queued downloads when bailing out (e.g. on Ctrl+C)
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+        
+        # Separate IPv4 and IPv6 networks by their version tag
+        ipv4_networks = {net for net in all_networks if net[0] == 4}
+        ipv6_networks = all_networks - ipv4_networks
         
         self.logger.info(f"Total networks found: {len(all_networks)} "
                    f"(IPv4: {len(ipv4_networks)}, IPv6: {len(ipv6_networks)}) for {self.country_code}")
@@ -142,15 +284,19 @@ class GeoIPACLDownloader:
         return ipv4_networks, ipv6_networks
     
     @staticmethod
-    def filter_supernets(networks: Set[ipaddress.IPv4Network | ipaddress.IPv6Network]) -> Set[ipaddress.IPv4Network | ipaddress.IPv6Network]:
+    def filter_supernets(networks: Set[NetworkTuple]) -> Set[NetworkTuple]:
         """
         Remove subnets that are contained within larger networks.
         
+        Besides dropping covered subnets, adjacent networks are merged as well
+        (e.g. two sibling /25s become one /24), matching ipaddress.collapse_addresses.
+        The address space covered by the result is unchanged.
+        
         Args:
-            networks: Set of IP networks to filter.
+            networks: Set of (version, address, prefixlen) tuples to filter.
             
         Returns:
-            Set of networks with redundant subnets removed.
+            Set of network tuples with redundant subnets removed.
         """
         if not networks:
             return set()
@@ -158,37 +304,47 @@ class GeoIPACLDownloader:
         logger = logging.getLogger(__name__)
         logger.info(f"Filtering {len(networks)} networks to remove redundant subnets...")
         
-        # Convert to sorted list for efficient processing
-        sorted_networks = sorted(networks, key=lambda x: (x.network_address, x.prefixlen))
+        # Sort once; tuples order by version first, so each family is one contiguous run
         filtered = set()
-        
-        for current_net in sorted_networks:
-            # Check if current network is a subnet of any network already in filtered set
-            is_subnet = any(
-                current_net != existing_net and current_net.subnet_of(existing_net)
-                for existing_net in filtered
-            )
+        for version, family in groupby(sorted(networks), key=itemgetter(0)):
+            width = _ADDRESS_WIDTHS[version]
+            sizes = [1 << (width - prefixlen) for prefixlen in range(width + 1)]
             
-            if not is_subnet:
-                # Remove any existing networks that are subnets of the current network
-                filtered = {
-                    net for net in filtered 
-                    if not (net != current_net and net.subnet_of(current_net))
-                }
-                filtered.add(current_net)
+            # Sorting by (address, prefixlen) puts every supernet before its subnets, so a
+            # kept network never has to be removed again and a network is covered iff it
+            # starts before the end of the last kept one
+            stack = []
+            end = 0
+            for _, addr, prefixlen in family:
+                if addr < end:
+                    continue
+                end = addr + sizes[prefixlen]
+                stack.append((addr, prefixlen))
+                
+                # Merge sibling halves into their parent for as long as possible
+                while len(stack) > 1:
+                    right_addr, right_prefixlen = stack[-1]
+                    left_addr, left_prefixlen = stack[-2]
+                    size = sizes[left_prefixlen]
+                    if (left_prefixlen != right_prefixlen or left_prefixlen == 0
+                            or left_addr + size != right_addr or left_addr & size):
+                        break
+                    stack.pop()
+                    stack[-1] = (left_addr, left_prefixlen - 1)
+            
+            filtered.update((version, addr, prefixlen) for addr, prefixlen in stack)
         
         reduction = len(networks) - len(filtered)
         logger.info(f"Filtered out {reduction} redundant subnets. {len(filtered)} networks remaining.")
         
         return filtered
     
-    def save_networks_to_file(self, networks: Set[ipaddress.IPv4Network | ipaddress.IPv6Network], 
-                             filename: str) -> None:
+    def save_networks_to_file(self, networks: Set[NetworkTuple], filename: str) -> None:
         """
         Save networks to a file.
         
         Args:
-            networks: Set of networks to save.
+            networks: Set of (version, address, prefixlen) tuples to save.
             filename: Output filename.
         """
         if not networks:
@@ -197,9 +353,15 @@ class GeoIPACLDownloader:
         
         try:
             output_path = Path(filename)
-            with open(output_path, 'w', encoding='utf-8') as f:
-                for net in sorted(networks):
-                    f.write(f"{net}\n")
+            # Tuples sort on plain ints; each network is formatted and encoded exactly once
+            lines = [
+                _NETWORK_CLASSES[version]((addr, prefixlen)).compressed.encode('ascii')
+                for version, addr, prefixlen in sorted(networks)
+            ]
+            
+            # CIDR strings are pure ASCII, so skip the text layer and write bytes directly
+            with open(output_path, 'wb', buffering=self.WRITE_BUFFER_SIZE) as f:
+                f.write(b'\n'.join(lines) + b'\n')
             
             self.logger.info(f"Saved {len(networks)} networks to {output_path.absolute()}")
         except IOError as e:
@@ -231,14 +393,19 @@ class GeoIPACLDownloader:
                            "Check country code and network connectivity.")
                 return
             
-            # Filter redundant subnets
-            if ipv4_networks:
-                ipv4_networks = self.filter_supernets(ipv4_networks)
-                self.save_networks_to_file(ipv4_networks, ipv4_file)
-            
-            if ipv6_networks:
-                ipv6_networks = self.filter_supernets(ipv6_networks)
-                self.save_networks_to_file(ipv6_networks, ipv6_file)
+            # Filter redundant subnets; the families are independent, so both filters
+            # are submitted at once and IPv4 is saved while IPv6 may still be filtering
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix='geoip-filter') as executor:
+                ipv4_future = executor.submit(self.filter_supernets, ipv4_networks)
+                ipv6_future = executor.submit(self.filter_supernets, ipv6_networks)
+                
+                ipv4_networks = ipv4_future.result()
+                if ipv4_networks:
+                    self.save_networks_to_file(ipv4_networks, ipv4_file)
+                
+                ipv6_networks = ipv6_future.result()
+                if ipv6_networks:
+                    self.save_networks_to_file(ipv6_networks, ipv6_file)
             
             elapsed = time.time() - start_time
             self.logger.info(f"Processing completed successfully in {elapsed:.2f} seconds")